@@ -2,8 +2,13 @@
 # encoding: utf-8
 
 # Stdlib:
-from itertools import combinations
-from collections import Counter, deque
+from itertools import chain, combinations, product, islice, repeat
+from collections import OrderedDict, defaultdict
+from operator import itemgetter
+from heapq import nsmallest, nlargest
+from functools import partial
+from array import array
+from multiprocessing import Pool
 
 import math
 import logging
@@ -12,12 +17,98 @@ LOGGER = logging.getLogger(__name__)
 
 # Internal:
 from munin.song import Song
+from munin.distance import Distance
 from munin.helper import sliding_window, centering_window, RunningMean
 from munin.history import ListenHistory, RuleIndex
 
 import munin.plot
 
 
+def _window_distances(dist_cache, window):
+    """Calculate the distances of all combinations of songs in window.
+
+    :param dist_cache: Mapping of uid pairs to already calculated distances.
+    :returns: A list of (song_a, song_b, distance) tuples.
+    """
+    compute = Song.distance_compute
+    results = []
+    for song_a, song_b in combinations(window, 2):
+        uid_a, uid_b = song_a.uid, song_b.uid
+        key = (uid_a, uid_b) if uid_a < uid_b else (uid_b, uid_a)
+        distance = dist_cache.get(key)
+        if distance is None:
+            distance = dist_cache[key] = compute(song_a, song_b)
+        results.append((song_a, song_b, distance))
+    return results
+
+
+def _join_candidates(song, threshold, max_neighbors, joined_uids):
+    """Select the neighbors of song that need to be joined with each other.
+
+    :param threshold: Only neighbors closer than this are taken.
+    :param joined_uids: Uids of the neighbors that were joined before.
+    :returns: A tuple of (neighbors, new, pairs): a dict of the selected
+              neighbors and their distance to song, the list of the neighbors
+              that were not joined before, and an iterator over the pairs
+              with at least one new neighbor.
+    """
+    # Take the closest neighbors that are close enough.
+    # Only max_neighbors are taken, since popular songs may have
+    # many more (the edges of other songs are mirrored to them).
+    # The neighbors are flattened to (song, float) pairs first,
+    # so selecting them does not need to compare Distance objects.
+    close = [
+        (ngb, dist.distance) for ngb, dist in song.distance_iter()
+        if dist.distance < threshold
+    ]
+    if len(close) > max_neighbors:
+        close = nsmallest(max_neighbors, close, key=itemgetter(1))
+    neighbors = dict(close)
+
+    # Pairs of already joined neighbors were compared before,
+    # so only pairs with at least one new neighbor are compared.
+    new = [ngb for ngb in neighbors if ngb.uid not in joined_uids]
+    pairs = chain(
+        combinations(new, 2),
+        product(new, [ngb for ngb in neighbors if ngb.uid in joined_uids])
+    )
+    return neighbors, new, pairs
+
+
+###########################################################################
+#                      Worker Processes for Rebuild                       #
+###########################################################################
+
+# DistanceKernel of the session (set by _init_worker in each worker)
+_WORKER_KERNEL = None
+
+
+def _init_worker(kernel):
+    'Initializer of the worker processes of a rebuild.'
+    global _WORKER_KERNEL
+    _WORKER_KERNEL = kernel
+
+
+def _compute_store_pairs(store_pairs):
+    """Compute the distances of (store_a, store_b) pairs in a worker process.
+
+    :returns: A list of distance values (as needed by Distance.from_values)
+    """
+    compute = _WORKER_KERNEL.compute
+    return [compute(store_a, store_b) for store_a, store_b in store_pairs]
+
+
+def _compute_store_row(row):
+    """Compute the distances of store_a to each of stores_b in a worker process.
+
+    :param row: A tuple of (store_a, stores_b).
+    :returns: A list of distance values (as needed by Distance.from_values)
+    """
+    store_a, stores_b = row
+    compute = _WORKER_KERNEL.compute
+    return [compute(store_a, store_b) for store_b in stores_b]
+
+
 class Database:
     'Class managing Database concerns.'
     def __init__(self, session):
@@ -40,6 +131,19 @@ class Database:
         self._song_list = []
         self._reset_history()
 
+        # Distances calculated during a rebuild (keyed by uid pairs),
+        # pairs are often compared more than once in the rebuild steps.
+        # Only filled while rebuild() runs, since uids may be reused later.
+        self._dist_cache = {}
+
+        # Inverted index for find_matching_attributes_generic():
+        # key -> processed value -> set of uids. Built lazily per key.
+        self._attribute_index = {}
+
+        # Value store (as tuple) -> uid of the first song with exactly these
+        # values. Lets insert() copy the distances of duplicates.
+        self._store_index = {}
+
     def _reset_history(self):
         self._revoked_uids = set()
         self._listen_history = ListenHistory(
@@ -50,7 +154,8 @@ class Database:
         self._rule_index = RuleIndex(
             maxlen=self._session.config['history_max_rules']
         )
-        self._playcounts = Counter()
+        # Playcounts indexed by uid, grown on demand:
+        self._playcounts = array('I')
 
     def __iter__(self):
         return filter(None, self._song_list)
@@ -86,20 +191,28 @@ class Database:
         munin.plot.plot(self, width, height, **kwargs)
 
     def playcount(self, song):
-        return self._playcounts.get(song, 0)
+        if song.uid < len(self._playcounts):
+            return self._playcounts[song.uid]
+        return 0
 
     def playcounts(self, n=0):
+        counts = self._playcounts
+        played = [(self._song_list[uid], count) for uid, count in enumerate(counts) if count]
         if n < 1:
-            return self._playcounts
+            return dict(played)
         else:
-            return self._playcounts.most_common(n)
+            return nlargest(n, played, key=itemgetter(1))
 
     def feed_history(self, song):
         if self._listen_history.feed(song):
             rules = self._listen_history.find_rules()
             self._rule_index.insert_rules(rules)
 
-        self._playcounts[song] += 1
+        counts = self._playcounts
+        if song.uid >= len(counts):
+            # Grow by doubling, so this is amortized O(1):
+            counts.extend(repeat(0, max(song.uid + 1, 2 * len(counts)) - len(counts)))
+        counts[song.uid] += 1
 
     def find_matching_attributes(self, subset, max_numeric_offset=None):
         if max_numeric_offset is None:
@@ -109,26 +222,44 @@ class Database:
 
     def find_matching_attributes_numeric(self, subset, max_offset):
         try:
-            numerics = {}
+            # (store index, lower bound, upper bound) for each key:
+            bounds = []
             for key, value in subset.items():
                 provider = self._session.provider_for_key(key)
-                numerics[key] = provider.process(value)
-
-            for song in self:
-                for key in (numerics.keys() & song.keys()):
-                    value = song.get(key)
-                    if value is None:
-                        break
-
-                    compar = numerics[key][0]
-                    if not (compar - max_offset <= value[0] <= compar + max_offset):
-                        break
-                else:
-                    yield song
-
+                compar = provider.process(value)[0]
+                bounds.append((
+                    self._session.index_for_key(key),
+                    compar - max_offset, compar + max_offset
+                ))
         except KeyError:
             raise KeyError('key "{k}" is not in mask'.format(k=key))
 
+        # Compare the values in the store directly, stop on the first mismatch.
+        # Attributes that are not set in a song are ignored.
+        for song in self:
+            store = song._store
+            for idx, lower, upper in bounds:
+                value = store[idx]
+                if value is not None and not (lower <= value[0] <= upper):
+                    break
+            else:
+                yield song
+
+    def _attribute_index_for_key(self, key):
+        by_value = self._attribute_index.get(key)
+        if by_value is None:
+            # Scan the column of key in the value stores once:
+            idx = self._session.index_for_key(key)
+            by_value = defaultdict(set)
+            for song in self:
+                try:
+                    by_value[song._store[idx]].add(song.uid)
+                except TypeError:
+                    # Unhashable values cannot match anyway.
+                    pass
+            self._attribute_index[key] = by_value
+        return by_value
+
     def find_matching_attributes_generic(self, subset):
         try:
             value_set = set()
@@ -136,12 +267,37 @@ class Database:
                 provider = self._session.provider_for_key(key)
                 value_set.add(provider.process(value))
 
-            for song in self:
-                if all((song[key] in value_set for key in subset.keys())):
-                    yield song
+            # Intersect the uids matching for each key:
+            uids = None
+            for key in subset.keys():
+                by_value = self._attribute_index_for_key(key)
+                matching = set().union(*[by_value.get(v, ()) for v in value_set])
+                uids = matching if uids is None else uids & matching
         except KeyError:
             raise KeyError('key "{k}" is not in mask'.format(k=key))
 
+        if uids is None:
+            uids = (song.uid for song in self)
+
+        for uid in sorted(uids):
+            yield self._song_list[uid]
+
+    def _make_pool(self, jobs):
+        """Create a pool of worker processes for computing distances.
+
+        Each worker gets the DistanceKernel of the session once,
+        afterwards only value stores need to be sent to it.
+        The caller has to terminate() the pool when done.
+
+        :param jobs: Number of worker processes.
+        :returns: A multiprocessing.Pool.
+        """
+        return Pool(
+            processes=jobs,
+            initializer=_init_worker,
+            initargs=(self._session._distance_kernel, )
+        )
+
     def _rebuild_step_base(self, mean_counter, window_size, step_size):
         """Do the Base Iterations.
 
@@ -168,26 +324,55 @@ class Database:
         anticn = centering_window(self, window_size // 2, parallel=False)
 
         # Prebind the functions for performance reasons.
-        compute = Song.distance_compute
-        add = Song.distance_add
+        add, sample = Song.distance_add, mean_counter.add_batch
 
-        # Select the iterator:
-        for idx, iterator in enumerate((slider, center, anticn)):
-            LOGGER.debug('|-- Applying iteration #{}: {}'.format(idx + 1, iterator))
+        # Distances may be computed in worker processes. Adding is always done
+        # here, so the neighbor lists of a Song have only a single writer.
+        jobs = self._session.config['rebuild_jobs']
+        max_cache_size = self._session.config['max_neighbors'] * len(self)
+        pool = self._make_pool(jobs) if jobs > 1 else None
 
-            # Iterate over the list:
-            for window in iterator:
-                # Calculate the combination set:
-                for song_a, song_b in combinations(window, 2):
-                    distance = compute(song_a, song_b)
-                    add(song_a, song_b, distance)
+        try:
+            # Select the iterator:
+            for idx, iterator in enumerate((slider, center, anticn)):
+                LOGGER.debug('|-- Applying iteration #{}: {}'.format(idx + 1, iterator))
 
-                    # Sample the newly calculated distance.
-                    mean_counter.add(distance.distance)
+                # Iterate over the list:
+                if pool is None:
+                    results = map(partial(_window_distances, self._dist_cache), iterator)
+                else:
+                    results = self._window_distances_parallel(
+                        pool, map(list, iterator), batch_size=jobs * 4
+                    )
+
+                for window_distances in results:
+                    # Keep the memory of the distance cache bounded:
+                    if len(self._dist_cache) >= max_cache_size:
+                        self._dist_cache.clear()
+
+                    # The distances are sampled once per window:
+                    batch_sum = batch_sumsq = 0.0
+                    for song_a, song_b, distance in window_distances:
+                        add(song_a, song_b, distance)
+                        value = distance.distance
+                        batch_sum += value
+                        batch_sumsq += value * value
+
+                    sample(len(window_distances), batch_sum, batch_sumsq)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
     def _rebuild_step_refine(self, mean_counter, num_passes=None, mean_scale=None):
         """Do the refinement step.
 
+        This is a *local join* like in NN-Descent: The neighbors of a song
+        are likely to be neighbors of each other too, therefore every pair of
+        neighbors (having a distance lower than the threshold) of a song is
+        compared and added. Pairs that were already compared in an earlier
+        pass are skipped.
+
         .. seealso:: :func:`rebuild`
 
         :param mean_counter: RunningMean Counter
@@ -202,37 +387,177 @@ class Database:
         # Prebind the functions for performance reasons:
         add = Song.distance_add
         compute = Song.distance_compute
+        distance_get = Song.distance_get
+        sample = mean_counter.add_batch
+
+        max_neighbors = self._session.config['max_neighbors']
+
+        # Keep the memory of the distance cache bounded:
+        dist_cache = self._dist_cache
+        max_cache_size = max_neighbors * len(self)
+
+        # Uids of the neighbors of each song (by uid) that were already
+        # joined with each other. Uids are dense, so a list is enough and
+        # no song has to be hashed.
+        joined = [()] * len(self._song_list)
+
+        # Exponentially weighted average of additions per song and pass:
+        found_ewma, ewma_alpha = 0.5, 0.3
+        min_found_rate = self._session.config['rebuild_refine_min_rate']
+
+        # Distances may be computed in worker processes:
+        jobs = self._session.config['rebuild_jobs']
+        pool = self._make_pool(jobs) if jobs > 1 else None
+
+        try:
+            # Do the whole thing `num_passes` times...
+            for n_iteration in range(num_passes):
+                threshold = (mean_counter.mean * mean_scale - mean_counter.sd) / mean_scale
+                newly_found = newly_sampled = 0
+
+                # Let the worker processes compute the distances, that this pass
+                # will probably need, beforehand. The pass itself is unchanged.
+                if pool is not None:
+                    self._prefetch_distances(
+                        pool, threshold, max_neighbors, joined, max_cache_size // 2
+                    )
+
+                # Go through the song_list...
+                for song in self:
+                    neighbors, new, pairs = _join_candidates(
+                        song, threshold, max_neighbors, joined[song.uid]
+                    )
+                    if not new:
+                        continue
+
+                    joined[song.uid] = {ngb.uid for ngb in neighbors}
+
+                    # ...and compare them with each other:
+                    batch_count, batch_sum, batch_sumsq = 0, 0.0, 0.0
+                    for song_a, song_b in pairs:
+                        if distance_get(song_a, song_b) is not None:
+                            continue
+
+                        uid_a, uid_b = song_a.uid, song_b.uid
+                        key = (uid_a, uid_b) if uid_a < uid_b else (uid_b, uid_a)
+                        distance = dist_cache.get(key)
+                        if distance is None:
+                            if len(dist_cache) >= max_cache_size:
+                                dist_cache.clear()
+                            distance = dist_cache[key] = compute(song_a, song_b)
+
+                        value = distance.distance
+                        batch_count += 1
+                        batch_sum += value
+                        batch_sumsq += value * value
+                        newly_found += add(song_a, song_b, distance)
+
+                    # The distances are sampled once per song:
+                    sample(batch_count, batch_sum, batch_sumsq)
+                    newly_sampled += batch_count
+
+                # If no pair was compared, neither the graph nor the threshold
+                # changed, so the next pass would do exactly the same (nothing).
+                if not newly_sampled:
+                    break
+
+                # Stop iteration when not enough new distances were gathered.
+                # The rate of additions per song is smoothed over the passes,
+                # so a single weak pass does not stop the refinement too early.
+                found_ewma = ewma_alpha * newly_found / len(self) + (1 - ewma_alpha) * found_ewma
+                if found_ewma < min_found_rate:
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
-        # Do the whole thing `num_passes` times...
-        for n_iteration in range(num_passes):
-            threshold = (mean_counter.mean * mean_scale - mean_counter.sd) / mean_scale
-            newly_found = 0
-
-            # Go through the song_list...
-            for idx, song in enumerate(self):
-                # ..and remember each calculated distance
-                # we got from compare the song with its indirect neighbors.
-                result_set = deque()
-
-                # Iterate over the indirect neighbors (those having a certain
-                # distance lower than threshold):
-                for ind_ngb in set(song.distance_indirect_iter(threshold)):
-                    distance = compute(song, ind_ngb)
-                    result_set.append((ind_ngb, distance))
-                    mean_counter.add(distance.distance)
-
-                # Add the distances (we should not do this during # iteration)
-                # Also count which of these actually
-                for ind_ngb, dist in result_set:
-                    newly_found += add(song, ind_ngb, dist)
-
-            # Stop iteration when not enough new distances were gathered
-            # (at least one new addition per song)
-            # This usually only triggers for high num_passes
-            if newly_found < len(self) // 2:
-                break
         LOGGER.debug('Did {}x (of max. {}) refinement steps.'.format(n_iteration, num_passes))
 
+    def _prefetch_distances(self, pool, threshold, max_neighbors, joined, max_count):
+        """Compute the distances a refinement pass will probably need.
+
+        The candidates are selected like in :func:`_rebuild_step_refine`,
+        but nothing is added; the distances are just put into the distance
+        cache. Only the value stores of the songs are sent to the workers.
+
+        :param pool: A pool from :func:`_make_pool`.
+        :param joined: Uids of the already joined neighbors (by uid).
+        :param max_count: Max. number of distances to compute.
+        """
+        dist_cache = self._dist_cache
+        if len(dist_cache) > max_count:
+            dist_cache.clear()
+
+        wanted = OrderedDict()
+        for song in self:
+            _, _, pairs = _join_candidates(song, threshold, max_neighbors, joined[song.uid])
+            for song_a, song_b in pairs:
+                if song_a.distance_get(song_b) is not None:
+                    continue
+
+                uid_a, uid_b = song_a.uid, song_b.uid
+                key = (uid_a, uid_b) if uid_a < uid_b else (uid_b, uid_a)
+                if key not in dist_cache:
+                    wanted[key] = (song_a._store, song_b._store)
+
+            if len(wanted) >= max_count:
+                break
+
+        self._compute_into_cache(pool, wanted, list(wanted)[:max_count])
+
+    def _compute_into_cache(self, pool, wanted, keys):
+        """Compute distances in the worker processes and put them into the cache.
+
+        :param pool: A pool from :func:`_make_pool`.
+        :param wanted: A mapping of uid pairs to (store_a, store_b).
+        :param keys: The uid pairs in wanted that shall be computed.
+        """
+        if not keys:
+            return
+
+        # Send rather large chunks, so the pickling overhead stays low:
+        chunk_size = max(1, len(keys) // (self._session.config['rebuild_jobs'] * 4))
+        chunks = [keys[idx:idx + chunk_size] for idx in range(0, len(keys), chunk_size)]
+        store_chunks = ([wanted[key] for key in chunk] for chunk in chunks)
+
+        dist_cache = self._dist_cache
+        for chunk, results in zip(chunks, pool.imap(_compute_store_pairs, store_chunks)):
+            for key, values in zip(chunk, results):
+                dist_cache[key] = Distance.from_values(self._session, values)
+
+    def _window_distances_parallel(self, pool, windows, batch_size):
+        """Like mapping :func:`_window_distances` over windows, but with workers.
+
+        The windows are processed in batches: The distances that are not
+        cached yet are computed by the workers, afterwards the distances of
+        each window in the batch are read from the cache.
+
+        :param pool: A pool from :func:`_make_pool`.
+        :param windows: An iterable of song lists.
+        :param batch_size: How many windows are sent to the workers at once.
+        :returns: A generator yielding a list of (song_a, song_b, distance)
+                  tuples per window.
+        """
+        dist_cache = self._dist_cache
+        windows = iter(windows)
+        for batch in iter(lambda: list(islice(windows, batch_size)), []):
+            wanted = OrderedDict()
+            for window in batch:
+                for song_a, song_b in combinations(window, 2):
+                    uid_a, uid_b = song_a.uid, song_b.uid
+                    key = (uid_a, uid_b) if uid_a < uid_b else (uid_b, uid_a)
+                    if key not in dist_cache:
+                        wanted[key] = (song_a._store, song_b._store)
+
+            self._compute_into_cache(pool, wanted, list(wanted))
+
+            # Read the whole batch before yielding,
+            # the caller might clear the cache in between.
+            results = [_window_distances(dist_cache, window) for window in batch]
+            for window_distances in results:
+                yield window_distances
+
     def rebuild_stupid(self):
         """(Re)build the graph by calculating the combination of all songs.
 
@@ -240,9 +565,50 @@ class Database:
         only should be ever used for a small amount of songs where accuracy
         matters even more thant time.
         """
-        for song_a, song_b in combinations(self._song_list, 2):
-            distance = Song.distance_compute(song_a, song_b)
-            Song.distance_add(song_a, song_b, distance)
+        session = self._session
+        compute = session._distance_kernel.compute
+        add = Song.distance_add
+
+        # Removed songs leave holes in the song list, skip them.
+        songs = list(self)
+
+        # With more than one job, the rows are computed in worker processes.
+        jobs = session.config['rebuild_jobs']
+        if jobs > 1:
+            rows = self._rebuild_stupid_rows(songs, jobs)
+        else:
+            rows = repeat(None, len(songs))
+
+        # The distances are computed row by row, so the value store of
+        # song_a and its known distances are only looked up once per row.
+        for idx, (song_a, row) in enumerate(zip(songs, rows)):
+            store_a, known = song_a._store, song_a._dist_dict
+            for pos, song_b in enumerate(islice(songs, idx + 1, None)):
+                distance = known.get(song_b)
+                if distance is None:
+                    if row is None:
+                        values = compute(store_a, song_b._store)
+                    else:
+                        values = row[pos]
+                    distance = Distance.from_values(session, values)
+                add(song_a, song_b, distance)
+
+    def _rebuild_stupid_rows(self, songs, jobs):
+        """Compute the rows of :func:`rebuild_stupid` in worker processes.
+
+        :returns: A generator yielding a list of distance values per song,
+                  one for each song after it.
+        """
+        stores = [song._store for song in songs]
+        rows = ((store, stores[idx + 1:]) for idx, store in enumerate(stores))
+        pool = self._make_pool(jobs)
+        try:
+            chunk_size = max(1, len(stores) // (jobs * 4))
+            for row in pool.imap(_compute_store_row, rows, chunk_size):
+                yield row
+        finally:
+            pool.terminate()
+            pool.join()
 
     def rebuild(self, window_size=None, step_size=None, refine_passes=None, stupid_threshold=None):
         """Rebuild all distances and the associated graph.
@@ -264,25 +630,31 @@ class Database:
             # Average and Standard Deviation Counter:
             mean_counter = RunningMean()
 
-            LOGGER.debug('+ Step #1: Calculating base distance (sliding window)')
-            self._rebuild_step_base(
-                mean_counter,
-                window_size=window_size,
-                step_size=step_size
-            )
-
-            LOGGER.debug('|-- Mean Distane: {:f} (sd: {:f})'.format(
-                mean_counter.mean, mean_counter.sd
-            ))
-            LOGGER.debug('+ Step #2: Applying refinement:')
-            self._rebuild_step_refine(
-                mean_counter,
-                num_passes=refine_passes
-            )
-
-            LOGGER.debug('|-- Mean Distane: {:f} (sd: {:f})'.format(
-                mean_counter.mean, mean_counter.sd
-            ))
+            # The distance cache is only valid during this rebuild,
+            # so it is dropped even if the rebuild fails.
+            self._dist_cache = {}
+            try:
+                LOGGER.debug('+ Step #1: Calculating base distance (sliding window)')
+                self._rebuild_step_base(
+                    mean_counter,
+                    window_size=window_size,
+                    step_size=step_size
+                )
+
+                LOGGER.debug('|-- Mean Distane: {:f} (sd: {:f})'.format(
+                    mean_counter.mean, mean_counter.sd
+                ))
+                LOGGER.debug('+ Step #2: Applying refinement:')
+                self._rebuild_step_refine(
+                    mean_counter,
+                    num_passes=refine_passes
+                )
+
+                LOGGER.debug('|-- Mean Distane: {:f} (sd: {:f})'.format(
+                    mean_counter.mean, mean_counter.sd
+                ))
+            finally:
+                self._dist_cache = {}
 
         self._reset_history()
 
@@ -303,13 +675,34 @@ class Database:
             max_distance=self._session.config['max_distance']
         )
 
+        self._attribute_index.clear()
         new_song.uid = self._current_uid()
         if new_song.uid >= len(self._song_list):
             self._song_list.append(new_song)
         else:
             self._song_list[new_song.uid] = new_song
+
+        self._index_store(new_song)
         return new_song.uid
 
+    def _index_store(self, song):
+        try:
+            self._store_index.setdefault(tuple(song._store), song.uid)
+        except TypeError:
+            # Unhashable values; such songs are just not deduplicated.
+            pass
+
+    def _find_twin(self, song):
+        'Find another song with exactly the same values as song or None.'
+        try:
+            uid = self._store_index.get(tuple(song._store))
+        except TypeError:
+            return None
+
+        if uid is None or uid == song.uid:
+            return None
+        return self._song_list[uid]
+
     def fix_graph(self):
         for song in self:
             song.distance_finalize()
@@ -341,6 +734,8 @@ class Database:
         )
         new_song.uid = self.remove(song.uid)
         self._song_list[song.uid] = new_song
+        self._attribute_index.clear()
+        self._index_store(new_song)
 
         # Clear all know distances:
         new_song.distance_reset()
@@ -361,20 +756,45 @@ class Database:
         else:
             iterstep = round(max(1, math.log(max(next_len, 1))))
 
+        # Prebind the functions for performance reasons:
+        compute, add = new_song.distance_compute, new_song.distance_add
+
+        # A song with the same values has the same distances to all others,
+        # so those can be just copied (but the twin itself is compared).
+        twin = self._find_twin(new_song)
+        if twin is not None:
+            add(twin, compute(twin))
+            for song, distance in list(twin.distance_iter()):
+                add(song, distance)
+            return new_song.uid
+
+        session = self._session
+        compute_values = session._distance_kernel.compute
+        new_store = new_song._store
+
         # Step 1: Find samples with similar songs (similar to the base step)
-        distances = deque()
-        for song in self._song_list[::iterstep]:
-            if song is not None:
-                distance = Song.distance_compute(song, new_song)
-                distances.append((song, distance))
-                new_song.distance_add(song, distance)
-
-        # Step 2: Short refinement step
-        for song, distance in distances:
+        # Only the songs that are needed for step 2 are remembered.
+        # new_song has no distances yet, so they are computed directly
+        # from the value stores, without looking into the distance dicts.
+        star_songs = []
+        for song in islice(self._song_list, 0, None, iterstep):
+            if song is None or song is new_song:
+                continue
+
+            distance = Distance.from_values(
+                session, compute_values(song._store, new_store)
+            )
+            add(song, distance)
             if distance.distance > star_threshold:
-                for neighbor in song.neighbors():
-                    distance = new_song.distance_compute(neighbor)
-                    new_song.distance_add(neighbor, distance)
+                star_songs.append(song)
+
+        # Step 2: Short refinement step.
+        # Neighbors shared by several star songs are only compared once.
+        candidates = OrderedDict.fromkeys(
+            chain.from_iterable(song.neighbors() for song in star_songs)
+        )
+        for neighbor in candidates:
+            add(neighbor, compute(neighbor))
 
         return new_song.uid
 
@@ -386,6 +806,22 @@ class Database:
         self._song_list[uid] = None
         self._revoked_uids.add(uid)
 
+        try:
+            store_key = tuple(song._store)
+            if self._store_index.get(store_key) == uid:
+                del self._store_index[store_key]
+        except TypeError:
+            pass
+
+        # The uid might be given to another song later:
+        if uid < len(self._playcounts):
+            self._playcounts[uid] = 0
+        self._attribute_index.clear()
+        if self._dist_cache:
+            self._dist_cache = {
+                key: dist for key, dist in self._dist_cache.items() if uid not in key
+            }
+
         # Patch the hole:
         song.disconnect()
 
@@ -401,6 +837,13 @@ if __name__ == '__main__':
     from munin.session import Session
     from munin.provider import Provider
 
+    def graph_of(database):
+        'The edges of the graph as comparable uid/distance lists.'
+        return [
+            sorted((other.uid, round(dist.distance, 6)) for other, dist in song.distance_iter())
+            for song in database
+        ]
+
     class DatabaseTests(unittest.TestCase):
         def setUp(self):
             self._session = Session('session_test', {
@@ -435,6 +878,27 @@ if __name__ == '__main__':
                         'artist': i / N
                     })
 
+        def test_playcounts(self):
+            database = self._session.database
+            a = database[database.add({'genre': 0.1, 'artist': 0.1})]
+            b = database[database.add({'genre': 0.2, 'artist': 0.2})]
+            self.assertEqual(database.playcount(a), 0)
+            self.assertEqual(database.playcounts(), {})
+
+            for song in (a, b, b):
+                database.feed_history(song)
+
+            self.assertEqual(database.playcount(a), 1)
+            self.assertEqual(database.playcount(b), 2)
+            self.assertEqual(database.playcounts(), {a: 1, b: 2})
+            self.assertEqual(database.playcounts(n=1), [(b, 2)])
+
+            # A recycled uid should not inherit the playcount:
+            database.remove(b.uid)
+            c = database[database.add({'genre': 0.3, 'artist': 0.3})]
+            self.assertEqual(c.uid, b.uid)
+            self.assertEqual(database.playcount(c), 0)
+
         def test_no_match(self):
             with self.assertRaisesRegex(KeyError, '.*mask.*'):
                 self._session.database.add({
@@ -463,6 +927,83 @@ if __name__ == '__main__':
                 self._session.insert({'genre': [0], 'artist': [0]})
             # self._session.database.plot(250, 250)
 
+        def test_rebuild_background(self):
+            from munin.helper import BackgroundJob
+
+            for idx in range(100):
+                self._session.database.add({
+                    'genre': (idx * 7 % 23) / 23, 'artist': (idx * 5 % 17) / 17
+                })
+
+            database = self._session.database
+            database.rebuild(stupid_threshold=0)
+            expected = graph_of(database)
+
+            job = BackgroundJob()
+            job.start(lambda: database.rebuild(stupid_threshold=0)).join()
+            self.assertFalse(job.running)
+            self.assertEqual(graph_of(database), expected)
+
+        def test_rebuild_failed(self):
+            database = self._session.database
+            for idx in range(50):
+                database.add({'genre': idx / 50, 'artist': idx % 7 / 7})
+
+            def fail(*args, **kwargs):
+                raise RuntimeError('aborted')
+
+            # The distances of the base step must not survive the failed rebuild:
+            database._rebuild_step_refine = fail
+            with self.assertRaises(RuntimeError):
+                database.rebuild(stupid_threshold=0)
+            self.assertEqual(database._dist_cache, {})
+
+        def test_rebuild_jobs(self):
+            from munin.session import DEFAULT_CONFIG
+
+            graphs = []
+            for jobs in (1, 2):
+                session = Session('session_test_jobs', {
+                    'genre': (None, None, 0.2),
+                    'artist': (None, None, 0.3)
+                }, config=dict(DEFAULT_CONFIG, rebuild_jobs=jobs))
+
+                for idx in range(100):
+                    session.database.add({
+                        'genre': (idx * 7 % 23) / 23, 'artist': (idx * 5 % 17) / 17
+                    })
+
+                # Once with the sliding windows and refinement, once brute force:
+                session.database.rebuild(stupid_threshold=0)
+                graphs.append(graph_of(session.database))
+                session.database.rebuild_stupid()
+                graphs.append(graph_of(session.database))
+
+            self.assertEqual(graphs[0], graphs[2])
+            self.assertEqual(graphs[1], graphs[3])
+
+        def test_insert_duplicate(self):
+            with self._session.transaction():
+                for idx in range(10):
+                    self._session.add({'genre': idx / 10, 'artist': idx / 10})
+
+            twin = self._session[3]
+            with self._session.fix_graph():
+                uid = self._session.insert({'genre': 0.3, 'artist': 0.3})
+
+            song = self._session[uid]
+            self.assertNotEqual(uid, twin.uid)
+            self.assertAlmostEqual(song.distance_get(twin).distance, 0.0)
+            for other, distance in twin.distance_iter():
+                if other is not song:
+                    self.assertAlmostEqual(
+                        song.distance_get(other).distance, distance.distance
+                    )
+
+            # After removing the twin, inserts are computed again:
+            self._session.remove(twin.uid)
+            self.assertIsNone(self._session.database._find_twin(song))
+
         def test_find_matching_attributes_numeric(self):
             from munin.provider import GenreTreeProvider
             from munin.distance import GenreTreeDistance
@@ -558,6 +1099,19 @@ if __name__ == '__main__':
             self.assertEqual(found[0], session[0])
             self.assertEqual(found[1], session[2])
 
+            # The index needs to be updated after adding/removing:
+            session.add({
+                'artist': 'Berta',
+                'genre': 'metal'
+            })
+            found = list(session.find_matching_attributes({'artist': 'Berta'}))
+            self.assertEqual(len(found), 3)
+            self.assertEqual(found[2], session[3])
+
+            session.remove(session[0])
+            found = list(session.find_matching_attributes({'artist': 'Berta'}))
+            self.assertEqual(found, [session[2], session[3]])
+
     def main():
         from munin.testing import DummyDistanceFunction
 
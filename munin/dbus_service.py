@@ -8,6 +8,8 @@ Limitations
 
 * No generator support for recommendations
 * You always work with Song uids, you created yourself.
+* While a rebuild runs, all other calls fail (with a RuntimeError);
+  clients should wait for the ``rebuild_finished`` signal.
 
 """
 
@@ -16,13 +18,13 @@ MUNIN_BUS_NAME = 'org.libmunin'
 MUNIN_INTERFACE = 'org.libmunin.Session'
 
 # Stdlib:
-import time
 import json
 import logging
 LOGGER = logging.getLogger(__name__)
 
 # Internal:
 from munin.easy import EasySession
+from munin.helper import BackgroundJob
 
 
 # External
@@ -53,6 +55,9 @@ class DBUSRemoteSession(dbus.service.Object):
         # Application data:
         self._session = EasySession()
 
+        # Rebuilds run in the background, everything else is rejected meanwhile:
+        self._rebuild_job = BackgroundJob()
+
         # DBUS data:
         bus = dbus.SessionBus()
         bus_name = dbus.service.BusName(MUNIN_BUS_NAME, bus=bus)
@@ -72,13 +77,41 @@ class DBUSRemoteSession(dbus.service.Object):
 
     @dbus.service.method(MUNIN_BUS_NAME)
     def rebuild(self, strategy='full'):
+        database = self._session.database
+        try:
+            rebuild_func = {
+                'full': database.rebuild,
+                'stupid': database.rebuild_stupid
+            }[strategy]
+        except KeyError:
+            raise ValueError('unknown rebuild strategy: ' + strategy)
+
+        def worker():
+            rebuild_func()
+            database.fix_graph()
+
+        # Do not block the mainloop (and therefore all other clients),
+        # rebuild_finished is emitted when the thread is done.
+        # Signals should only be emitted from the mainloop's thread though.
+        thread = self._rebuild_job.start(
+            worker, on_done=lambda: GLib.idle_add(self._emit_rebuild_finished)
+        )
+        if thread is None:
+            LOGGER.warning('Server: rebuild is already running')
+            return
+
         self.rebuild_started()
-        time.sleep(2)
+
+    def _emit_rebuild_finished(self):
         self.rebuild_finished()
 
+        # Remove the idle source again:
+        return False
+
     @dbus.service.method(MUNIN_BUS_NAME)
     def fix_graph(self):
-        self._session.fix_graph()
+        with self._rebuild_job.exclusive():
+            self._session.database.fix_graph()
 
     #############
     #  Mapping  #
@@ -86,19 +119,23 @@ class DBUSRemoteSession(dbus.service.Object):
 
     @dbus.service.method(MUNIN_BUS_NAME, out_signature='a{uu}')
     def mapping(self):
-        return dict(self._session.mapping)
+        with self._rebuild_job.exclusive():
+            return dict(self._session.mapping)
 
     @dbus.service.method(MUNIN_BUS_NAME, out_signature='a{uu}')
     def inverse_mapping(self):
-        return dict(~self._session.mapping)
+        with self._rebuild_job.exclusive():
+            return dict(~self._session.mapping)
 
     @dbus.service.method(MUNIN_BUS_NAME, out_signature='u')
     def forward_lookup(self, munin_id):
-        return self._session.mapping[munin_id:]
+        with self._rebuild_job.exclusive():
+            return self._session.mapping[munin_id:]
 
     @dbus.service.method(MUNIN_BUS_NAME, out_signature='u')
     def inverse_lookup(self, user_id):
-        return self._session.mapping[:user_id]
+        with self._rebuild_job.exclusive():
+            return self._session.mapping[:user_id]
 
     ######################
     #  Song modifcation  #
@@ -106,18 +143,38 @@ class DBUSRemoteSession(dbus.service.Object):
 
     @dbus.service.method(MUNIN_BUS_NAME, in_signature='su')
     def add(self, json_mapping, user_id):
-        uid = self._session.add(json.loads(json_mapping))
-        self._session.mapping[uid] = user_id
+        with self._rebuild_job.exclusive():
+            uid = self._session.add(json.loads(json_mapping))
+            self._session.mapping[uid] = user_id
 
     @dbus.service.method(MUNIN_BUS_NAME, in_signature='su')
     def insert(self, json_mapping, user_id):
-        uid = self._session.insert(json.loads(json_mapping))
-        self._session.mapping[uid] = user_id
+        with self._rebuild_job.exclusive():
+            uid = self._session.insert(json.loads(json_mapping))
+            self._session.mapping[uid] = user_id
+
+    @dbus.service.method(MUNIN_BUS_NAME, in_signature='asau')
+    def add_many(self, json_mappings, user_ids):
+        'Like add, but for many songs in one call (saves a roundtrip per song)'
+        with self._rebuild_job.exclusive():
+            mapping = self._session.mapping
+            for json_mapping, user_id in zip(json_mappings, user_ids):
+                mapping[self._session.add(json.loads(json_mapping))] = user_id
+
+    @dbus.service.method(MUNIN_BUS_NAME, in_signature='asau')
+    def insert_many(self, json_mappings, user_ids):
+        'Like insert, but for many songs in one call; the graph is fixed once'
+        with self._rebuild_job.exclusive():
+            mapping = self._session.mapping
+            with self._session.fix_graph():
+                for json_mapping, user_id in zip(json_mappings, user_ids):
+                    mapping[self._session.insert(json.loads(json_mapping))] = user_id
 
     @dbus.service.method(MUNIN_BUS_NAME, in_signature='su')
     def remove(self, json_mapping, user_id):
-        uid = self._session.remove(json.loads(json_mapping))
-        del self._session.mapping[uid]
+        with self._rebuild_job.exclusive():
+            uid = self._session.remove(json.loads(json_mapping))
+            del self._session.mapping[uid]
 
     #####################
     #  Recommendations  #
@@ -125,8 +182,9 @@ class DBUSRemoteSession(dbus.service.Object):
 
     @dbus.service.method(MUNIN_BUS_NAME, in_signature='uu')
     def recommendations_from_seed(self, song_id, number):
-        uid = self._session.mapping[:song_id]
-        self._session.recommendations_from_seed(uid, number)
+        with self._rebuild_job.exclusive():
+            uid = self._session.mapping[:song_id]
+            self._session.recommendations_from_seed(uid, number)
 
     # TODO
 
@@ -2,6 +2,9 @@
 # encoding: utf-8
 
 # stdlib:
+from array import array
+from operator import eq
+
 import logging
 import abc
 
@@ -43,6 +46,25 @@ class DistanceFunction:
 
         return self.do_compute(lefts, rights)
 
+    @property
+    def compute_func(self):
+        """The callable to use instead of :func:`compute` in tight loops.
+
+        Without a compressing provider there is nothing to look up,
+        so :func:`do_compute` is returned directly (unless compute is overriden).
+        The default :func:`do_compute` only checks for equality, and the ids of
+        a compressing provider are equal exactly if their values are,
+        so it can compare the ids without looking them up.
+        """
+        cls = type(self)
+        if cls.compute is not DistanceFunction.compute:
+            return self.compute
+        if self._provider is None or not self._provider.compress:
+            return self.do_compute
+        if cls.do_compute is DistanceFunction.do_compute:
+            return self.do_compute
+        return self.compute
+
     ##############################
     #  Interface for subclasses  #
     ##############################
@@ -56,11 +78,13 @@ class DistanceFunction:
         :return: Number of matches divivded through the max length of both lists.
         """
         # Default to max. diversity:
-        n_max = max(len(list_a), len(list_b))
-        if n_max is 0:
+        n_a, n_b = len(list_a), len(list_b)
+        n_max = n_a if n_a > n_b else n_b
+        if n_max == 0:
             return 1.0
 
-        return 1.0 - sum(a == b for a, b in zip(list_a, list_b)) / n_max
+        # map() with operator.eq compares the pairs without a generator frame.
+        return 1.0 - sum(map(eq, list_a, list_b)) / n_max
 
 
 ###########################################################################
@@ -68,6 +92,13 @@ class DistanceFunction:
 ###########################################################################
 
 
+# Marker for unset values in Distance (NaN is the only float unequal to itself)
+_UNSET = float('nan')
+
+# Distances are compared (and hashed) on this grid, so equal ones hash equally.
+_EQ_SCALE = 10 ** 9
+
+
 class Distance(SessionMapping):
     __slots__ = ('distance')
 
@@ -82,13 +113,39 @@ class Distance(SessionMapping):
         :param dist_dict: A mapping to read the distance values from.
         :type dist_dict: mapping<str, float>
         """
-        # Use only a list internally to save the values.
+        # Use only a packed float array internally to save the values.
+        # Doubles are used, so the values read back are exactly the computed ones.
         # Keys are stored shared in the Session objective.
-        SessionMapping.__init__(self, session, dist_dict, default_value=None)
-        self.distance = session._weight(dist_dict)
+        # Unset values are marked with NaN, since array() can't hold None.
+        self._session = session
+        values = [_UNSET] * session.mask_length
+        for key, value in dist_dict.items():
+            values[session.index_for_key(key)] = value
+
+        # Missing distances count as max. distance (1.0).
+        self._store = array('d', values)
+        self.distance = session._distance_kernel.weight(values)
+
+    ####################################
+    #  Mapping Protocol Satisfication  #
+    ####################################
+
+    def __getitem__(self, key):
+        value = self._store[self._session.index_for_key(key)]
+        return None if value != value else value
+
+    def __iter__(self):
+        at = self._session.key_at_index
+        return ((at(idx), v) for idx, v in enumerate(self._store) if v == v)
+
+    def values(self):
+        return (None if v != v else v for v in self._store)
+
+    def keys(self):
+        return (key for key, _ in self)
 
     def __eq__(self, other):
-        return float_cmp(self.distance, other.distance)
+        return int(self.distance * _EQ_SCALE) == int(other.distance * _EQ_SCALE)
 
     def __lt__(self, other):
         return self.distance < other.distance
@@ -97,11 +154,25 @@ class Distance(SessionMapping):
         return '~{d:f}'.format(d=self.distance)
 
     def __hash__(self):
-        return hash(self.distance)
+        return int(self.distance * _EQ_SCALE)
 
     def __invert__(self):
         return 1.0 - self.distance
 
+    @staticmethod
+    def from_values(session, values):
+        """Create a Distance from a list of distances ordered like a Song's store.
+
+        This skips the key lookups of the constructor, the rebuild uses it.
+
+        :param values: A list of floats (NaN for unset values).
+        """
+        distance = Distance.__new__(Distance)
+        distance._session = session
+        distance._store = array('d', values)
+        distance.distance = session._distance_kernel.weight(values)
+        return distance
+
     @staticmethod
     def make_dummy(session):
         return Distance(
@@ -155,6 +226,27 @@ if __name__ == '__main__':
                     0.5
             )
 
+        def test_compute_func(self):
+            from munin.provider import Provider
+            plain = DistanceFunction(provider=Provider())
+            self.assertEqual(plain.compute_func, plain.do_compute)
+            self.assertAlmostEqual(plain.compute_func((1, 2), (1, 3)), 0.5)
+
+            # Comparing the ids gives the same result as comparing the values:
+            provider = Provider(compress=True)
+            compressed = DistanceFunction(provider=provider)
+            a, b = provider.process('Akrea'), provider.process('Berta')
+            self.assertEqual(compressed.compute_func, compressed.do_compute)
+            self.assertAlmostEqual(compressed.compute_func(a, a), 0.0)
+            self.assertAlmostEqual(compressed.compute_func(a, b), 1.0)
+
+            class LengthDistance(DistanceFunction):
+                def do_compute(self, list_a, list_b):
+                    return abs(len(list_a) - len(list_b))
+
+            custom = LengthDistance(provider=Provider(compress=True))
+            self.assertEqual(custom.compute_func, custom.compute)
+
     class DistanceTest(unittest.TestCase):
         def setUp(self):
             self._session = Session('test', {
@@ -178,4 +270,34 @@ if __name__ == '__main__':
             dist = Distance(self._session, {'genre': 0.5, 'random': 0.1})
             self.assertTrue(float_cmp(dist.distance, (0.5 * 0.5 + 0.1 * 0.1) / 0.6))
 
+        def test_exact_values(self):
+            dist = Distance(self._session, {'genre': 0.1, 'random': 1 / 3})
+            self.assertEqual(dist['genre'], 0.1)
+            self.assertEqual(dist['random'], 1 / 3)
+            self.assertEqual(
+                Distance.from_values(self._session, [0.1, 1 / 3]),
+                Distance(self._session, {'genre': 0.1, 'random': 1 / 3})
+            )
+
+        def test_eq_hash(self):
+            a = Distance(self._session, {'genre': 0.5, 'random': 0.1})
+            b = Distance(self._session, {'random': 0.1, 'genre': 0.5})
+            c = Distance(self._session, {'genre': 0.4, 'random': 0.1})
+            self.assertEqual(a, b)
+            self.assertEqual(hash(a), hash(b))
+            self.assertNotEqual(a, c)
+            self.assertEqual(len({a, b, c}), 2)
+
+        def test_from_values(self):
+            # Stores are ordered by the sorted keys: genre, random
+            for dist_dict, values in [
+                ({'genre': 0.5, 'random': 0.1}, [0.5, 0.1]),
+                ({'genre': 0.0}, [0.0, _UNSET]),
+                ({}, [_UNSET, _UNSET]),
+            ]:
+                expected = Distance(self._session, dist_dict)
+                dist = Distance.from_values(self._session, values)
+                self.assertEqual(dist.distance, expected.distance)
+                self.assertEqual(dict(dist), dict(expected))
+
     unittest.main()
@@ -21,9 +21,33 @@ Reference
 from munin.distance import DistanceFunction
 
 
+# Range of the BPM values that are compared (50 to 250):
+_MIN_BPM, _MAX_DIFF = 50, 200
+
+
 class BPMDistance(DistanceFunction):
     """Distance Function that compares two Beats Per Minute Lists."""
     def do_compute(self, lefts, rights):
-        max_n = 200
-        left, right = max(0, lefts[0] - 50), max(0, rights[0] - 50)
-        return abs(max(left, max_n) - max(right, max_n)) / max_n
+        # Clamp both values into [0, _MAX_DIFF] relative to the minimum:
+        left, right = lefts[0] - _MIN_BPM, rights[0] - _MIN_BPM
+        left = 0 if left < 0 else (_MAX_DIFF if left > _MAX_DIFF else left)
+        right = 0 if right < 0 else (_MAX_DIFF if right > _MAX_DIFF else right)
+        return abs(left - right) / _MAX_DIFF
+
+
+if __name__ == '__main__':
+    import unittest
+
+    class BPMDistanceTest(unittest.TestCase):
+        def test_bpm(self):
+            dfunc = BPMDistance()
+            self.assertAlmostEqual(dfunc.do_compute((120.0, ), (120.0, )), 0.0)
+            self.assertAlmostEqual(dfunc.do_compute((50.0, ), (250.0, )), 1.0)
+            self.assertAlmostEqual(dfunc.do_compute((100.0, ), (150.0, )), 0.25)
+            self.assertAlmostEqual(dfunc.do_compute((150.0, ), (100.0, )), 0.25)
+
+            # Values outside of the range are clamped:
+            self.assertAlmostEqual(dfunc.do_compute((10.0, ), (50.0, )), 0.0)
+            self.assertAlmostEqual(dfunc.do_compute((40.0, ), (300.0, )), 1.0)
+
+    unittest.main()
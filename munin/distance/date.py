@@ -47,11 +47,12 @@ class DateDistance(DistanceFunction):
         DistanceFunction.__init__(self, **kwargs)
         self._min, self._now = 1970, date.today().year
         self._max_diff = (self._now - self._min) or 1
+        self._inv_max_diff = 1.0 / self._max_diff
 
     def do_compute(self, lefts, rights):
-        left, right = lefts[0], rights[0]
-        diff = abs(left - right) / self._max_diff
-        return max(0.0, min(1.0, diff))
+        # abs() is never negative, so only the upper bound needs clamping.
+        diff = abs(lefts[0] - rights[0]) * self._inv_max_diff
+        return diff if diff < 1.0 else 1.0
 
 
 if __name__ == '__main__':
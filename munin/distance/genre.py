@@ -2,24 +2,46 @@
 # encoding: utf-8
 
 # Stdlib:
-from itertools import product
+from functools import lru_cache
+from itertools import product, repeat
 
 # Internal:
 from munin.distance import DistanceFunction
 from munin.helper import float_cmp
 
 
-def compare_single_path(left, right):
-    """Compare a single path with another.
+# Songs share few distinct genre paths, so the same pairs come up over and over.
+# Only called with tuples, the smaller path first (see compare_single_path).
+@lru_cache(maxsize=2 ** 16)
+def _compare_path_pair(left, right):
+    n_left, n_right = len(left), len(right)
+    n_max = n_left if n_left > n_right else n_right
 
-    :returns: The ratio of matching numbers divided by max. length of both.
-    """
-    n = 0.0
+    # Equal paths are common (and the best case), compare them in one go:
+    if left == right:
+        return 0.0 if n_max else 1.0
+
+    n = 0
     for l, r in zip(left, right):
         if l != r:
             break
         n += 1
-    return 1 - n / (max(len(left), len(right)) or 1)
+    return 1 - n / (n_max or 1)
+
+
+def compare_single_path(left, right):
+    """Compare a single path with another.
+
+    :param left: A genre path (any sequence of ints).
+    :param right: Another genre path.
+    :returns: The ratio of matching numbers divided by max. length of both.
+    """
+    left, right = tuple(left), tuple(right)
+
+    # The distance is symmetric, so (a, b) and (b, a) share one cache entry:
+    if right < left:
+        left, right = right, left
+    return _compare_path_pair(left, right)
 
 
 class GenreTreeAvgDistance(DistanceFunction):
@@ -34,11 +56,17 @@ class GenreTreeAvgDistance(DistanceFunction):
         if not lefts or not rights:
             return 1.0
 
+        # Paths might come in as lists, the cache needs them hashable:
+        lefts = [tuple(left) for left in lefts]
+        rights = [tuple(right) for right in rights]
+
         dists = 0
-        lefts, rights = sorted([lefts, rights], key=len, reverse=True)
+        if len(lefts) < len(rights):
+            lefts, rights = rights, lefts
 
+        # map() calls compare_single_path without a generator frame per path.
         for left in lefts:
-            dists += min(compare_single_path(left, right) for right in rights)
+            dists += min(map(compare_single_path, repeat(left), rights))
 
         return dists / len(lefts)
 
@@ -55,13 +83,18 @@ class GenreTreeDistance(DistanceFunction):
         :param rights: A list of Genre Paths to compare with.
         :returns: A distance between 0.0 and 1.0 (max diversity.)
         """
+        lefts = [tuple(left) for left in lefts]
+        rights = [tuple(right) for right in rights]
+
         min_dist = 1.0
         for left, right in product(lefts, rights):
-            min_dist = min(min_dist, compare_single_path(left, right))
+            dist = compare_single_path(left, right)
+            if dist < min_dist:
+                min_dist = dist
 
-            # Optimization: Often we get a low value early.
-            if float_cmp(min_dist, 0.0):
-                break
+                # Optimization: Often we get a low value early.
+                if float_cmp(min_dist, 0.0):
+                    break
 
         return min_dist
 
@@ -89,6 +122,22 @@ if __name__ == '__main__':
                     float_cmp(compare_single_path(right, left), result)
                 )
 
+        def test_list_input(self):
+            self.assertAlmostEqual(compare_single_path([190, 1, 0], [190, 1, 1]), 1 / 3)
+            self.assertAlmostEqual(compare_single_path([190, 1, 0], (190, 1, 0)), 0)
+
+            calc = GenreTreeDistance(GenreTreeProvider())
+            self.assertAlmostEqual(calc.compute([[1, 0]], [[1, 1]]), 0.5)
+            calc = GenreTreeAvgDistance(GenreTreeProvider())
+            self.assertAlmostEqual(calc.compute([[1, 0]], [(1, 0), [0, 1]]), 0.5)
+
+        def test_symmetric_cache(self):
+            _compare_path_pair.cache_clear()
+            compare_single_path((7, 1), (7, 2, 3))
+            compare_single_path((7, 2, 3), (7, 1))
+            info = _compare_path_pair.cache_info()
+            self.assertEqual((info.hits, info.misses), (1, 1))
+
     class TestGenreTreeAvgDistanceFunction(unittest.TestCase):
         def test_valid(self):
             calc = GenreTreeAvgDistance(GenreTreeProvider())
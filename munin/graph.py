@@ -7,6 +7,7 @@ Methods to traverse the graph in order to do recommendations.
 # Stdlib:
 from itertools import chain, islice
 from collections import deque
+from heapq import nlargest
 import random
 
 # Internal
@@ -133,7 +134,8 @@ def explain_recommendation(session, seed_song, recommendation, max_reasons=3):
         weight = session.weight_for_key(attr)
         return weight * (1 - dist)
 
-    return (distance, sorted(distance.items(), key=sort_func, reverse=True))
+    # Only the best max_reasons are needed, no need to sort all of them:
+    return (distance, nlargest(max_reasons, distance.items(), key=sort_func))
 
 
 if __name__ == '__main__':
@@ -15,17 +15,24 @@ Contains method that help the user of the library finding the date he needs.
 
     * :func:`pairup` - Easy Mask building.
 
+    * :class:`BackgroundJob` - Run a job (like a rebuild) in a thread.
+
 Reference
 ---------
 """
 
 from collections import Mapping
+from contextlib import contextmanager
 from itertools import chain, cycle, islice, zip_longest
+from threading import Thread, Lock
 
+import logging
 import math
 import sys
 import os
 
+LOGGER = logging.getLogger(__name__)
+
 
 ###########################################################################
 #                             AudioFileWalker                             #
@@ -191,6 +198,27 @@ class RunningMean:
         self.rsdv += last_diff * (value - self.mean)
         self.samples += 1
 
+    def add_batch(self, count, sum_, sumsq):
+        """Add many values at once, given by their count, sum and squared sum.
+
+        :param count: The number of values.
+        :param sum_: The sum of the values.
+        :param sumsq: The sum of the squares of the values.
+        """
+        if count <= 0:
+            return
+
+        batch_mean = sum_ / count
+        batch_rsdv = max(sumsq - sum_ * batch_mean, 0.0)
+
+        # Merge the two partitions (Chan et al.):
+        prev_count = self.samples - 1
+        total = prev_count + count
+        delta = batch_mean - self.mean
+        self.mean += delta * count / total
+        self.rsdv += batch_rsdv + delta * delta * prev_count * count / total
+        self.samples += count
+
     @property
     def sd(self):
         if self.samples <= 2:
@@ -199,6 +227,63 @@ class RunningMean:
         v = math.sqrt(self.rsdv / (self.samples - 2))
         return v
 
+###########################################################################
+#                              BackgroundJob                              #
+###########################################################################
+
+class BackgroundJob:
+    """Run a job in a background thread, only one at a time.
+
+    Other work on the data the job modifies must be wrapped in
+    :func:`exclusive`, which fails instead of waiting while the job runs.
+    This way a mainloop is never blocked by a long job.
+    """
+    def __init__(self):
+        self._lock = Lock()
+
+    @property
+    def running(self):
+        'True while a job is running (or exclusive() is held).'
+        return self._lock.locked()
+
+    def start(self, func, on_done=None):
+        """Call func() in a daemon thread.
+
+        :param on_done: Called in the thread after func, even if func failed.
+        :returns: The started Thread, or None if a job is already running.
+        """
+        if not self._lock.acquire(False):
+            return None
+
+        thread = Thread(target=self._run, args=(func, on_done))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self, func, on_done):
+        try:
+            func()
+        except Exception:
+            LOGGER.exception('background job failed')
+        finally:
+            self._lock.release()
+            if on_done is not None:
+                on_done()
+
+    @contextmanager
+    def exclusive(self):
+        """Contextmanager that makes sure no job runs meanwhile.
+
+        :raises RuntimeError: If a job is running right now.
+        """
+        if not self._lock.acquire(False):
+            raise RuntimeError('a background job is running, try again later')
+
+        try:
+            yield
+        finally:
+            self._lock.release()
+
 ###########################################################################
 #                             SessionMapping                              #
 ###########################################################################
@@ -273,6 +358,34 @@ if __name__ == '__main__':
                 ex = [[0, 1, 9, 8], [2, 3, 7, 6], [4, 5]]
                 self.assertEqual(ex, wnds)
 
+            def test_background_job(self):
+                from threading import Event
+
+                job, go, done, result = BackgroundJob(), Event(), Event(), []
+
+                def func():
+                    go.wait()
+                    result.append(1)
+
+                thread = job.start(func, on_done=done.set)
+                self.assertTrue(job.running)
+                self.assertIsNone(job.start(func))
+                with self.assertRaises(RuntimeError):
+                    with job.exclusive():
+                        pass
+
+                go.set()
+                thread.join()
+                self.assertTrue(done.is_set())
+                self.assertEqual(result, [1])
+                self.assertFalse(job.running)
+
+                # A failing job must not keep the lock:
+                job.start(lambda: 1 / 0).join()
+                with job.exclusive():
+                    self.assertTrue(job.running)
+                self.assertFalse(job.running)
+
             def test_running_mean(self):
                 run = RunningMean()
                 self.assertAlmostEqual(run.mean, 0.0)
@@ -283,6 +396,20 @@ if __name__ == '__main__':
                 self.assertAlmostEqual(run.mean, 2.0)
                 self.assertAlmostEqual(run.sd, 1.0)
 
+            def test_running_mean_batch(self):
+                values = [0.1, 0.5, 0.25, 0.75, 0.3]
+                single, batch = RunningMean(), RunningMean()
+                for value in values:
+                    single.add(value)
+
+                batch.add(values[0])
+                rest = values[1:]
+                batch.add_batch(len(rest), sum(rest), sum(v * v for v in rest))
+                batch.add_batch(0, 0.0, 0.0)
+                self.assertAlmostEqual(single.mean, batch.mean)
+                self.assertAlmostEqual(single.sd, batch.sd)
+                self.assertEqual(single.samples, batch.samples)
+
         unittest.main()
     else:
         walker = AudioFileWalker(sys.argv[1])
@@ -102,7 +102,7 @@ def association_rules(data, min_confidence=0.5, min_support=2, min_kulc=0.66, ma
             # Start with one left=item, right=rest
             left, right = frozenset([item]), itemset.difference([item])
 
-            while len(right) is not 0 and (left, right) not in visited:
+            while right and (left, right) not in visited:
                 # We copy right, so it does not get harmed during iteration:
                 for item in chain(right, [None]):
                     append_rule(
@@ -274,7 +274,7 @@ class ListenHistory(History):
             itemsets = self.frequent_itemsets(min_support=min_support)
 
         rules = association_rules(itemsets, min_support=min_support, **kwargs)
-        return sorted(rules, key=lambda x: x[-1], reverse=True)
+        return sorted(rules, key=_sort_by_rating, reverse=True)
 
 
 class RecommendationHistory(History):
@@ -375,7 +375,7 @@ class RuleIndex:
 
         Requires O(n log n). This could be optimized.
         """
-        return iter(sorted(self._rule_list.values(), key=lambda rule: 1.0 - rule[-1]))
+        return iter(sorted(self._rule_list.values(), key=_sort_by_rating, reverse=True))
 
     def __contains__(self, rule_tuple):
         'Check if a rule tuple is in the index. Only considers songs in it.'
@@ -386,27 +386,12 @@ class RuleIndex:
 
         :returns: a tuple of (rule_uid, rule_tuple)
         """
-        first_song = next(iter(rule_tuple[0]))
         lefts, rights, *_ = rule_tuple
-        candidate_ids = set()
+        uid = self._rule_keys.get(frozenset((lefts, rights)))
+        if uid is None:
+            return None, None
 
-        # Locate all rules that contain a song in the input rule
-        for uid in self._rule_dict.get(first_song, ()):
-            if uid in self._rule_list:
-                candidate_ids.add(uid)
-
-        # Check those for left/right idendity (instead of checking all rules)
-        for uid in candidate_ids:
-            stored_tuple = self._rule_list[uid]
-            stored_lefts, stored_rights, *_ = stored_tuple
-
-            if lefts == stored_lefts and rights == stored_rights:
-                return uid, stored_tuple
-
-            if rights == stored_lefts and lefts == stored_rights:
-                return uid, stored_tuple
-
-        return None, None
+        return uid, self._rule_list[uid]
 
     def clear(self):
         """Clear all known rules.
@@ -417,6 +402,10 @@ class RuleIndex:
         self._rule_dict = defaultdict(set)
         self._rule_cuid = 0
 
+        # {left, right} -> rule_uid for _locate(). The key does not
+        # depend on the direction, so every rule is stored only once.
+        self._rule_keys = {}
+
     def best(self):
         """Return the currently best rule (the one with the highest rating)
 
@@ -425,7 +414,7 @@ class RuleIndex:
         :returns: A ruletuple or None if no rule yet in the index.
         """
         try:
-            return max(self._rule_list.values(), key=lambda rule: rule[-1])
+            return max(self._rule_list.values(), key=_sort_by_rating)
         except ValueError:
             return None
 
@@ -465,11 +454,14 @@ class RuleIndex:
 
         # Step 2: Remember this rule, so we can look it up later.
         self._rule_list[self._rule_cuid] = rule_tuple
+        self._rule_keys[frozenset((left, right))] = self._rule_cuid
         self._rule_cuid += 1
 
         # Step 3: Prune the index, if too big.
         if len(self._rule_list) > self._max_rules:
             fst_uid, fst_rule = self._rule_list.popitem(last=False)
+            fst_left, fst_right, *_ = fst_rule
+            del self._rule_keys[frozenset((fst_left, fst_right))]
             if drop_invalid:
                 for uid_set in self._rule_dict.values():
                     uid_set.discard(fst_uid)
@@ -558,6 +550,7 @@ if __name__ == '__main__':
 
                 # Check the number of items in the index:
                 self.assertEqual(len(self._idx._rule_list), 5)
+                self.assertEqual(len(self._idx._rule_keys), 5)
                 self.assertEqual(len(self._idx._rule_dict), 10)
                 for value in self._idx._rule_dict.values():
                     if setting is False:
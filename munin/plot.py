@@ -2,26 +2,27 @@
 # encoding: utf-8
 
 from colorsys import hsv_to_rgb
-from collections import deque
 
 
 def _build_graph_from_song_list(graph, song_list):
-    for song in song_list:
-        graph.add_vertex(song=song)
-
-    # Gather all edges in one container
-    # (this speeds up adding edges)
-    edge_set = deque()
-    for song_a in song_list:
-        for song_b, _ in song_a.distance_iter():
-            # Make Edge Deduplication work:
-            if song_a.uid < song_b.uid:
-                edge_set.append((song_b.uid, song_a.uid))
-            else:
-                edge_set.append((song_a.uid, song_b.uid))
-
-    # Filter duplicate edge pairs.
-    graph.add_edges(set(edge_set))
+    # Add all vertices at once, the vertex index is the position in songs
+    # (which differs from the uid if songs were removed before)
+    songs = list(song_list)
+    graph.add_vertices(len(songs))
+    graph.vs['song'] = songs
+    vx_index = {song: idx for idx, song in enumerate(songs)}
+
+    # Gather all edges in one container (this speeds up adding edges).
+    # Mutual edges are seen from both sides, so they are only taken from
+    # the side with the lower index. This way no set is needed to deduplicate.
+    edges = []
+    for idx_a, song_a in enumerate(songs):
+        for song_b in song_a.neighbors():
+            idx_b = vx_index[song_b]
+            if idx_a < idx_b or song_a not in song_b.neighbors():
+                edges.append((idx_a, idx_b))
+
+    graph.add_edges(edges)
 
 
 def _color_from_distance(distance):
@@ -29,17 +30,29 @@ def _color_from_distance(distance):
     return '#{:02x}{:02x}{:02x}'.format(r, g, b)
 
 
+# Edge colors are precomputed once, so plotting large graphs
+# does not need to format a new string per edge.
+_DIST_COLOR_STEPS = 256
+_DIST_COLOR_LUT = [
+    _color_from_distance(idx / (_DIST_COLOR_STEPS - 1))
+    for idx in range(_DIST_COLOR_STEPS)
+]
+
+
 def _edge_color_list(graph):
-    edge_colors, edge_widths = deque(), deque()
+    edge_colors, edge_widths = [], []
 
-    for edge in graph.es:
-        a, b = graph.vs[edge.source]['song'], graph.vs[edge.target]['song']
-        distance = a.distance_get(b)
+    # Fetch the songs and edges in bulk instead of per edge:
+    songs = graph.vs['song']
+    for idx_a, idx_b in graph.get_edgelist():
+        distance = songs[idx_a].distance_get(songs[idx_b])
         if distance is not None:
-            edge_colors.append(_color_from_distance(distance.distance))
+            # Same scale as the table was built with (distances are in [0, 1]):
+            lut_idx = int(round(distance.distance * (_DIST_COLOR_STEPS - 1)))
+            edge_colors.append(_DIST_COLOR_LUT[lut_idx])
             edge_widths.append((1.0 - distance.distance) * 0.9)
 
-    return list(edge_colors), list(edge_widths)
+    return edge_colors, edge_widths
 
 
 def _format_vertex_label(mapping, uid):
@@ -50,8 +63,17 @@ def _format_vertex_label(mapping, uid):
         return str(uid)
 
 
+# Graphs with more vertices than this are laid out on a grid.
+_LARGE_GRAPH_SIZE = 500
+
+
 def _style(graph, vx_mapping, width, height):
     colors = graph.eigenvector_centrality(directed=False)
+
+    # Fruchterman-Reingold compares all vertices with each other per step,
+    # with a grid only vertices in neighboring cells are compared.
+    layout = graph.layout('fr', grid=graph.vcount() > _LARGE_GRAPH_SIZE)
+
     edge_color, edge_width = _edge_color_list(graph)
     return {
         'edge_color': edge_color,
@@ -60,11 +82,11 @@ def _style(graph, vx_mapping, width, height):
         'vertex_label_color': [hsv_to_rgb(1 - v, 0.2, 0.1) for v in colors],
         'vertex_label_size': 35,
         'vertex_size': 30,
-        'layout': graph.layout('fr'),
+        'layout': layout,
         'bbox': (width, height),
         'margin': (500, 500, 500, 500),
         'vertex_label': [
-            _format_vertex_label(vx_mapping, vx['song'].uid) for vx in graph.vs
+            _format_vertex_label(vx_mapping, song.uid) for song in graph.vs['song']
         ],
     }
 
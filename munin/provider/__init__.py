@@ -42,6 +42,9 @@ class Provider:
             self._store = bidict()
             self._last_id = 0
 
+            # Resolved id tuples; ids are never reassigned, so these stay valid.
+            self._lookup_cache = {}
+
     def __or__(self, other_provider):
         """Allows to chain providers by bit oring them.
 
@@ -57,6 +60,16 @@ class Provider:
         return CompositeProvider([self, other_provider])
 
     def _lookup(self, idx_list):
+        try:
+            return self._lookup_cache[idx_list]
+        except KeyError:
+            values = self._lookup_cache[idx_list] = self._resolve(idx_list)
+            return values
+        except TypeError:
+            # Unhashable input (like a list) - just resolve it.
+            return self._resolve(idx_list)
+
+    def _resolve(self, idx_list):
         return tuple(self._store[:idx] for idx in idx_list)
 
     def process(self, input_value):
@@ -98,7 +98,7 @@ def wiki_genres_for(page):
         text, _ = text.split(END_STRING, maxsplit=1)
 
     parts = START_PAT.split(text, maxsplit=1)
-    if len(parts) is 2:
+    if len(parts) == 2:
         text = parts[1]
 
     for line in text.splitlines():
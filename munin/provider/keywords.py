@@ -124,7 +124,7 @@ class PlyrLyricsProvider(Provider):
             first = items[0]
 
             # This item was cached on failure:
-            if first.rating is -1:
+            if first.rating == -1:
                 return None
 
             try:
@@ -33,7 +33,7 @@ def draw_moodbar(ctx, rgb, w, h):
 
         odd = 0
         for idx in range(0, w, 50):
-            if odd % 2 is 0:
+            if odd % 2 == 0:
                 ctx.set_source_rgb(0.25, 0.25, 0.25)
             else:
                 ctx.set_source_rgb(0.3, 0.3, 0.3)
@@ -122,10 +122,10 @@ def draw_moodbar(ctx, rgb, w, h):
         x = min(max(i - 5, 0), w - 21)
         text = str(int(i / scale_step)) + '%'
 
-        if i % (scale_step * 10) is 0:
+        if i % (scale_step * 10) == 0:
             height, width = h / 15, 2
             draw_text_at_pos(ctx, x, h - height - 10, '<b>{}</b>'.format(text), font_size=6)
-        elif i % (scale_step * 5) is 0:
+        elif i % (scale_step * 5) == 0:
             height, width = h / 20, 1.5
             draw_text_at_pos(ctx, x, h - height - 8, '<i>{}</i>'.format(text), font_size=5)
         else:
@@ -144,7 +144,7 @@ def read_moodbar_values(path):
     with open(path, 'rb') as handle:
         vector = handle.read()
 
-    if len(vector) is 0:
+    if not vector:
         raise OSError('broken moodbar file: ' + path)
 
     for rgb in grouper(vector, n=3):
@@ -48,6 +48,7 @@ from bidict import bidict
 
 # Internal:
 from munin.database import Database
+from munin.song import DistanceKernel
 from munin.history import RecommendationHistory
 from munin.helper import song_or_uid
 
@@ -83,6 +84,12 @@ def get_cache_path(extra_name=None):
     return base_dir if not extra_name else os.path.join(base_dir, extra_name)
 
 
+# Bumped whenever the pickled layout of a Session changes incompatibly.
+# Version 2: Distances keep their values packed in an array, every Session
+# has a generated DistanceKernel. Older sessions have to be created again.
+SESSION_FORMAT_VERSION = 2
+
+
 DEFAULT_CONFIG = {
     'max_neighbors': 15,  # Average length of an album in tracks + 1.
     'max_distance': 0.999,
@@ -94,7 +101,9 @@ DEFAULT_CONFIG = {
     'rebuild_step_size': 20,
     'rebuild_refine_passes': 25,
     'rebuild_mean_scale': 2,
+    'rebuild_refine_min_rate': 0.02,
     'rebuild_stupid_threshold': 350,
+    'rebuild_jobs': 1,
     'recom_history_sieving': True,
     'recom_history_penalty': {
         'album': 5,
@@ -138,6 +147,7 @@ class Session:
         """
         self._config = config
         self._name = name
+        self._format_version = SESSION_FORMAT_VERSION
 
         # Publicly readable attribute.
         self.mapping = {}
@@ -173,9 +183,23 @@ class Session:
                 lambda key: 1.0
         )
 
+        # Same as above, but ordered like the values in a Song's store.
+        # This way distances can be computed column by column.
+        self._distfunc_list = [
+            self._key_to_distfuncs[key] for key in self._attribute_list
+        ]
+
         # Sum of the individual weights, pre-calculated once.
         self._weight_sum = sum((descr[2] for descr in mask.values()))
 
+        # Computing and weighting distances of two stores, specialized for the mask.
+        # Every Distance is weighted by it, so the mask is not unpacked per call.
+        self._distance_kernel = DistanceKernel(
+            self._distfunc_list,
+            [(self._listidx_to_key[key], descr[2]) for key, descr in self._mask.items()],
+            self._weight_sum
+        )
+
         # Create the associated database.
         self._database = Database(self)
 
@@ -258,18 +282,6 @@ class Session:
         'Get the weighting (*float*) for ``key``'
         return self._key_to_weighting[key]
 
-    def _weight(self, dist_dict):
-        'This is in Session for performance reasons'
-        dist_sum = 0.0
-
-        for key, (_, _, weight) in self._mask.items():
-            try:
-                dist_sum += dist_dict[key] * weight
-            except KeyError:
-                dist_sum += weight
-
-        return dist_sum / self._weight_sum
-
     ############################
     #  Caching Implementation  #
     ############################
@@ -288,9 +300,14 @@ class Session:
             If you prefer to save the sessions in XDG_CACHE_HOME anyway,
             just use :func:`Session.from_name`.
 
+        .. note::
+
+            Sessions saved with an incompatible version of libmunin
+            (see ``SESSION_FORMAT_VERSION``) are not loaded, None is returned.
+
         :param full_path: a path to a packed session.
         :type full_path: str
-        :returns: A cached session.
+        :returns: A cached session (or None if it could not be loaded).
         :rtype: :class:`Session`
         """
         base_path, _ = os.path.splitext(full_path)
@@ -299,11 +316,20 @@ class Session:
                 tar.extractall(base_path)
 
             with open(os.path.join(base_path, 'session.pickle'), 'rb') as handle:
-                return pickle.load(handle)
-        except OSError as err:
+                session = pickle.load(handle)
+        except (OSError, pickle.UnpicklingError, AttributeError) as err:
             LOGGER.debug('Could not load session: ' + str(err))
             return None
 
+        version = getattr(session, '_format_version', 1)
+        if version != SESSION_FORMAT_VERSION:
+            LOGGER.warning('Session was saved in format #{} (need #{}), not loading'.format(
+                version, SESSION_FORMAT_VERSION
+            ))
+            return None
+
+        return session
+
     @staticmethod
     def from_name(session_name):
         """Like :func:`from_archive_path`, but be clever and load it
@@ -693,4 +719,29 @@ if __name__ == '__main__':
             new_session = Session.from_archive_path(path)
             self.assertEqual(new_session.mask, self._mask)
 
+        def test_pickle(self):
+            with self._session.transaction():
+                for idx in range(10):
+                    self._session.add({'genre': idx / 10, 'artist': idx % 3 / 3})
+
+            copied = pickle.loads(pickle.dumps(self._session))
+            for song, other in zip(self._session.database, copied.database):
+                self.assertEqual(
+                    [(ngb.uid, dist.distance) for ngb, dist in song.distance_iter()],
+                    [(ngb.uid, dist.distance) for ngb, dist in other.distance_iter()]
+                )
+
+            # The distance kernel is generated again and still works:
+            a, b = copied.database[0], copied.database[1]
+            self.assertEqual(
+                copied._distance_kernel.compute(a._store, b._store),
+                self._session._distance_kernel.compute(a._store, b._store)
+            )
+
+        def test_writeout_old_format(self):
+            # Sessions from before the format version was saved:
+            del self._session._format_version
+            self._session.save('/tmp')
+            self.assertIsNone(Session.from_archive_path('/tmp/session_test.gz'))
+
     unittest.main()
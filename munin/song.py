@@ -11,10 +11,79 @@ from logging import getLogger
 LOGGER = getLogger(__name__)
 
 # Internal:
-from munin.distance import Distance
+from munin.distance import Distance, _UNSET
 from munin.helper import SessionMapping
 
 
+class DistanceKernel:
+    """Distance computation specialized for the mask of one session.
+
+    The code of :func:`compute` and :func:`weight` is generated once, with
+    the loop over the columns unrolled and the weights inserted as literals.
+    This is done since these two are called for every pair of songs.
+
+    On pickling only the arguments are saved, the code is generated again.
+    """
+    def __init__(self, distance_funcs, weight_index_list, weight_sum):
+        """
+        :param distance_funcs: The :class:`munin.distance.DistanceFunction`
+                               instances, ordered like the stores.
+        :param weight_index_list: (store index, weight) pairs in summation order.
+        :param weight_sum: The sum of all weights.
+        """
+        # Only the DistanceFunction objects are kept for pickling,
+        # bound methods can not be pickled before Python 3.4.
+        self._args = (distance_funcs, weight_index_list, weight_sum)
+
+        namespace = {'_UNSET': _UNSET}
+        columns = range(len(distance_funcs))
+        for idx, func in enumerate(distance_funcs):
+            namespace['compute_{}'.format(idx)] = func.compute_func
+
+        def literal(value, name):
+            if type(value) in (int, float):
+                return repr(value)
+            namespace[name] = value
+            return name
+
+        def unpack(prefix, name):
+            if not columns:
+                return 'pass'
+            return ''.join('{}{}, '.format(prefix, idx) for idx in columns) + '= ' + name
+
+        source = """
+def compute(store_a, store_b):
+    {a}
+    {b}
+    return [{computes}]
+
+def weight(values):
+    {v}
+    return (0.0{terms}) / {weight_sum}
+""".format(
+            a=unpack('a', 'store_a'),
+            b=unpack('b', 'store_b'),
+            v=unpack('v', 'values'),
+            computes=', '.join(
+                'compute_{i}(a{i}, b{i}) if a{i} is not None and b{i} is not None else _UNSET'
+                .format(i=idx) for idx in columns
+            ),
+            terms=''.join(
+                ' + (v{i} if v{i} == v{i} else 1.0) * {w}'.format(
+                    i=idx, w=literal(weight, 'weight_{}'.format(idx))
+                ) for idx, weight in weight_index_list
+            ),
+            weight_sum=literal(weight_sum, 'weight_sum')
+        )
+
+        exec(compile(source, '<DistanceKernel>', 'exec'), namespace)
+        self.compute = namespace['compute']
+        self.weight = namespace['weight']
+
+    def __reduce__(self):
+        return (DistanceKernel, self._args)
+
+
 class Song(SessionMapping, Hashable):
     # Note: Use __slots__ (sys.getsizeof will report even more memory, but pympler less)
     __slots__ = ('_dist_dict', '_pop_list', '_max_distance', '_max_neighbors',
@@ -85,8 +154,8 @@ class Song(SessionMapping, Hashable):
     def __lt__(self, other):
         return id(self) < id(other)
 
-    def __hash__(self):
-        return id(self)
+    # Hash by identity, but without calling a python function each time.
+    __hash__ = object.__hash__
 
     def __repr__(self):
         return '<Song(uid={uid} values={val}, distances={dst})>'.format(
@@ -118,16 +187,10 @@ class Song(SessionMapping, Hashable):
             if self is other_song:
                 return Distance.make_dummy(self._session)
 
-            distance_dict = {}
-            for key in set(self.keys()).intersection(other_song.keys()):
-                distance_func = self._session.distance_function_for_key(key)
-                value_a, value_b = self[key], other_song[key]
-                if value_a is None or value_b is None:
-                    distance_dict[key] = int(value_a is not value_b)
-                else:
-                    distance_dict[key] = distance_func(value_a, value_b)
-
-            return Distance(self._session, distance_dict)
+            session = self._session
+            return Distance.from_values(
+                session, session._distance_kernel.compute(self._store, other_song._store)
+            )
 
     def distance_add(self, other, distance):
         """Add a relation to ``other`` with a certain distance.
@@ -165,14 +228,7 @@ class Song(SessionMapping, Hashable):
 
         # Check if we still have room left
         if len(sdd) >= self._max_neighbors:
-            # Find the worst song in the dictionary
-            while 1:
-                inversion, worst_song = self._pop_list[0]
-                if worst_song in sdd:
-                    worst_dist = 1.0 - inversion
-                    break
-                heappop(self._pop_list)
-
+            worst_song, worst_dist = self._find_worst()
             if worst_dist < distance.distance:
                 # we could prune pop_list here too,
                 # but it showed that one operation only is more effective.
@@ -196,32 +252,39 @@ class Song(SessionMapping, Hashable):
         self._worst_cache = None
         return True
 
+    def _find_worst(self):
+        """Find the worst song in the dictionary.
+
+        Entries in the pop list that are not neighbors anymore are dropped.
+
+        :returns: a tuple of (worst_song, worst_distance_float)
+        """
+        sdd, pop_list = self._dist_dict, self._pop_list
+        while 1:
+            inversion, worst_song = pop_list[0]
+            if worst_song in sdd:
+                return worst_song, 1.0 - inversion
+            heappop(pop_list)
+
     def distance_finalize(self):
         """Delete/Fix all invalid edges and neighbors of this song"""
-        to_consider = deque()
-
-        if self in self._dist_dict:
-            del self._dist_dict[self]
-
-        for other in self._dist_dict:
-            dist_a, dist_b = self.distance_get(other), other.distance_get(self)
-            if dist_a is None:
-                to_consider.append((other, self))
-            if dist_b is None:
-                to_consider.append((self, other))
-
-        for source, target in to_consider:
-            count = 0
-            for other in self.neighbors():
-                dist_a, dist_b = self.distance_get(other), other.distance_get(self)
-                if dist_a is None or dist_b is None:
-                    continue
-                count += 1
-
+        sdd = self._dist_dict
+        if self in sdd:
+            del sdd[self]
+
+        # distance_add() always stores self -> other and other -> self,
+        # only evicting a worse neighbor may leave a unidirectional edge.
+        # Therefore checking the back-edge is enough here.
+        to_consider = deque(other for other in sdd if self not in other._dist_dict)
+
+        # Number of neighbors that have a edge back to us:
+        count = len(sdd) - len(to_consider)
+        for other in to_consider:
             if count < self._max_neighbors:
-                target._dist_dict[source] = source.distance_get(target)
+                other._dist_dict[self] = sdd[other]
+                count += 1
             else:
-                del source._dist_dict[target]
+                del sdd[other]
 
         self._dist_dict = OrderedDict(sorted(self._dist_dict.items(), key=itemgetter(1)))
         self._reset_invariants()
@@ -458,4 +521,34 @@ if __name__ == '__main__':
                 self.assertTrue(a.distance_get(b))
                 self.assertAlmostEqual(a.distance_get(b).distance, 0.0)
 
+        def test_distance_kernel(self):
+            import pickle
+
+            kernel = self._session._distance_kernel
+            a = Song(self._session, {'genre': [0], 'artist': [0]})
+            b = Song(self._session, {'genre': [1], 'artist': [0]})
+            c = Song(self._session, {'genre': [1]})
+
+            for song_a, song_b in combinations((a, b, c), 2):
+                values = kernel.compute(song_a._store, song_b._store)
+
+                # Only attributes set in both songs get a distance:
+                expected = Distance(self._session, {
+                    key: self._session.distance_function_for_key(key).compute(
+                        song_a[key], song_b[key]
+                    )
+                    for key in ('artist', 'genre')
+                    if song_a[key] is not None and song_b[key] is not None
+                })
+                distance = Distance.from_values(self._session, values)
+                self.assertEqual(dict(distance), dict(expected))
+                self.assertEqual(kernel.weight(values), expected.distance)
+
+            # The generated code is not pickled, but generated again:
+            copied = pickle.loads(pickle.dumps(kernel))
+            self.assertEqual(
+                str(copied.compute(a._store, c._store)),
+                str(kernel.compute(a._store, c._store))
+            )
+
     unittest.main()